@@ -4,6 +4,16 @@ import socket
 import logging as log
 import typing
 
+# Received bytes not yet terminated by a newline
+rxbuf = bytearray()
+# Reused for every recv instead of allocating a new bytes object
+recv_view = memoryview(bytearray(1024))
+
+VALID_GUESSES = frozenset(("true", "false"))
+TERMINAL_GUESS_CODES = frozenset(("3021", "3022", "3023"))
+
+SOCKET_BUFFER_SIZE = 65536
+
 
 def format_ip(addr: socket._RetAddress) -> str:
     return f"{addr[0]}:{addr[1]}"
@@ -13,7 +23,10 @@ def connect_server(addr: str, port: int) -> socket.socket:
     try:
         assert 0 <= port <= 65535
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
         sock.connect((addr, port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
     except AssertionError as e:
         log.critical(f"Invalid port: {e}")
         exit(1)
@@ -28,7 +41,7 @@ def connect_server(addr: str, port: int) -> socket.socket:
 
 def send(sock: socket.socket, msg: str) -> None:
     try:
-        sock.send(msg.encode("ascii"))
+        sock.send(f"{msg}\n".encode("ascii"))
     except socket.error as e:
         log.critical(f"Socket error: {e}")
         exit(1)
@@ -38,8 +51,17 @@ def send(sock: socket.socket, msg: str) -> None:
 
 def recv(sock: socket.socket) -> str:
     try:
-        msg = sock.recv(1024).decode("ascii")
-        assert msg
+        # Read until a whole message is buffered; extra bytes are kept
+        idx = rxbuf.find(b"\n")
+        while idx == -1:
+            n = sock.recv_into(recv_view)
+            assert n
+            rxbuf.extend(recv_view[:n])
+            idx = rxbuf.find(b"\n")
+
+        frame = bytes(rxbuf[:idx])
+        del rxbuf[:idx + 1]
+        msg = frame.decode("ascii")
         log.info(f"Received {msg} from server")
     except socket.error as e:
         log.critical(f"Socket error: {e}")
@@ -56,6 +78,11 @@ def recv(sock: socket.socket) -> str:
     return msg
 
 
+def status_code(msg: str) -> str:
+    # Only the leading code is needed, so skip tokenizing the message text
+    return msg.partition(" ")[0]
+
+
 def authenticate(sock: socket.socket) -> bool:
     authenticated = False
     while not authenticated:
@@ -65,7 +92,7 @@ def authenticate(sock: socket.socket) -> bool:
         send(sock, f"/login {username} {password}")
         msg = recv(sock)
 
-        if msg.split()[0] == "1001":
+        if status_code(msg) == "1001":
             authenticated = True
 
     return authenticated
@@ -75,7 +102,7 @@ def handle_exit(sock: socket.socket) -> None:
     sock.shutdown(1)
     while True:
         respond = recv(sock)
-        if respond.split()[0] == "4001":
+        if status_code(respond) == "4001":
             sock.close()
             break
 
@@ -88,7 +115,7 @@ def handle_game(sock: socket.socket) -> None:
     while True:
         while True:
             guess = input("Guess true or false: ")
-            if guess not in ["true", "false"]:
+            if guess not in VALID_GUESSES:
                 print("Invalid guess. Please input 'true' or 'false'")
                 continue
             else:
@@ -96,22 +123,22 @@ def handle_game(sock: socket.socket) -> None:
 
         send(sock, f"/guess {guess}")
         respond = recv(sock)
-        if respond.split()[0] in ["3021", "3022", "3023"]:
+        if status_code(respond) in TERMINAL_GUESS_CODES:
             break
 
 
 def handle_enter(sock: socket.socket) -> None:
-    respond = recv(sock)
+    code = status_code(recv(sock))
 
-    if respond.split()[0] == "3013":  # Room full
+    if code == "3013":  # Room full
         return
 
-    if respond.split()[0] == "3011":  # Wait
+    if code == "3011":  # Wait
         while True:
-            respond = recv(sock)
-            if respond.split()[0] == "3012":  # Started
+            code = status_code(recv(sock))
+            if code == "3012":  # Started
                 break
-    if respond.split()[0] == "3012":  # Started
+    if code == "3012":  # Started
         handle_game(sock)
 
 
@@ -124,22 +151,22 @@ def handle_lobby(sock: socket.socket) -> None:
     exited = False
     while not exited:
         while True:
-            msg = input("> ")
-            if not msg:
+            segs = input("> ").split()
+            if not segs:
                 continue
-            if msg.split()[0] not in COMMAND_HANDLERS:
+            if segs[0] not in COMMAND_HANDLERS:
                 print(
                     "Invalid command. Available commands: /exit, /list, /enter <room number>")
                 continue
-            if len(msg.split()) != COMMAND_LENGTHS[msg.split()[0]]:
+            if len(segs) != COMMAND_LENGTHS[segs[0]]:
                 print(f"Invalid number of arguments.")
                 continue
-            if msg:
-                break
+            break
 
-        send(sock, msg)
-        COMMAND_HANDLERS[msg.split()[0]](sock)
-        if msg == "/exit":
+        # Rejoin with single spaces, which is what the server parses
+        send(sock, " ".join(segs))
+        COMMAND_HANDLERS[segs[0]](sock)
+        if segs[0] == "/exit":
             exited = True
 
 
@@ -3,10 +3,27 @@ from pathlib import Path
 import logging as log
 import sys
 import socket
-import threading
+import select
 from enum import Enum, auto
-from typing import cast
 import random
+import types
+import hashlib
+import re
+import errno
+
+# Fixed protocol replies, encoded once as complete newline-terminated frames
+MSG = types.SimpleNamespace(
+    AUTH_OK=b"1001 Authentication successful\n",
+    AUTH_FAIL=b"1002 Authentication failed\n",
+    WAIT=b"3011 Wait\n",
+    STARTED=b"3012 Game started. Please guess true or false\n",
+    FULL=b"3013 The room is full\n",
+    WIN=b"3021 You won this game\n",
+    LOSE=b"3022 You lost this game\n",
+    TIE=b"3023 The result is a tie\n",
+    BYE=b"4001 Bye Bye\n",
+    BAD=b"4002 Unrecognized message\n",
+)
 
 
 def format_ip(addr: socket._RetAddress) -> str:
@@ -15,385 +32,522 @@ def format_ip(addr: socket._RetAddress) -> str:
 
 class Player:
     class ExitedException(Exception):
-        def __init__(self, player: Player, *args, **kwargs) -> None:
-            self.player = player
-            super().__init__(*args)
+        pass
 
     class State(Enum):
+        AUTHENTICATING = auto()
         LOBBY = auto()
         WAITING = auto()
         INGAME = auto()
         DISCONNECTED = auto()
 
     def __str__(self) -> str:
-        return f"Player at {format_ip(self.addr)}"
+        return self._str
 
     def __init__(self, sock: socket.socket, addr: socket._RetAddress) -> None:
-        self.state = Player.State.LOBBY
+        self.state = Player.State.AUTHENTICATING
         self.room: GameRoom | None = None
+        self.slot: int | None = None
         self.sock = sock
         self.addr = addr
-        self.lock = threading.Lock()
-        self.exitedException = self.ExitedException(
-            self, f"{self} exited unexpectedly")
+        # The peer address never changes, so format it once
+        self._str = f"Player at {format_ip(addr)}"
+        # Received bytes not yet terminated by a newline
+        self.rxbuf = bytearray()
+        # Set while dropping the rest of an oversized message up to its newline
+        self.discarding = False
+        # Bytes not yet accepted by the kernel send buffer
+        self.txbuf = bytearray()
+        # Cleared after a short write, set again by the next EPOLLOUT event
+        self.writable = True
+
+    def join(self, room: GameRoom) -> bool:
+        if room.is_full():
+            return False
 
-    def join(self, room: GameRoom) -> bool | None:
         self.room = room
         self.state = Player.State.WAITING
-        return room.add_player(self)
+        room.add_player(self)
+        return True
 
     def leave(self) -> None:
-        log.info(f"{self} left the room")
+        log.info("%s left the room", self)
         self.state = Player.State.LOBBY
         if self.room is not None:
             self.room.remove_player(self)
         self.room = None
+        self.slot = None
 
     def exit(self) -> None:
         self.state = Player.State.DISCONNECTED
 
-    def send(self, msg: str) -> None:
+    def send(self, frame: bytes) -> None:
+        log.debug("Sending message to %s: %r", self, frame)
+        self.txbuf += frame
+
+        # Sent in one syscall at the end of the event loop iteration
+        unflushed.add(self)
+
+    def flush(self) -> None:
+        # The send buffer is full; EPOLLOUT will resume the flush
+        if not self.writable or not self.txbuf:
+            return
+
         try:
-            log.debug(f"Sending message to {self}: {msg}")
-            self.sock.send(msg.encode("ascii"))
+            sent = self.sock.send(self.txbuf)
+        except BlockingIOError:
+            self.writable = False
+            return
         except socket.error as e:
-            log.error(f"Socket error: {e}")
-            self.state = Player.State.DISCONNECTED
-            raise self.exitedException
-        except UnicodeEncodeError as e:
-            log.error(f"Failed to encode message: {e}")
-            self.state = Player.State.DISCONNECTED
-            raise self.exitedException
+            raise self.ExitedException(
+                f"{self} exited unexpectedly: {e}") from e
+
+        del self.txbuf[:sent]
+        self.writable = not self.txbuf
 
 
 class UserList:
+    @staticmethod
+    def digest(credentials: bytes) -> bytes:
+        return hashlib.blake2b(credentials, digest_size=16).digest()
+
     def __init__(self, path: Path | None = None) -> None:
-        self.users = dict[str, str]()
-        if Path is not None:
-            self.load(cast(Path, path))
+        # Digests of "username:password" lines; plaintext passwords are not kept
+        self.credentials = frozenset[bytes]()
+        # Modification time of the file the current table was parsed from
+        self._mtime = 0.0
+        if path is not None:
+            self.load(path)
 
     def load(self, path: Path) -> None:
         try:
-            with open(path) as file:
-                self.users = {line.strip().split(":")[0]: line.strip().split(":")[
-                    1] for line in file.readlines()}
+            mtime = path.stat().st_mtime
+            if mtime == self._mtime:
+                return
+
+            with open(path, "rb") as file:
+                data = file.read()
+            self.credentials = frozenset(
+                self.digest(line) for line in data.splitlines() if b":" in line)
+            self._mtime = mtime
         except:
-            log.error(f"Failed to open user info file at {path}")
+            log.error("Failed to open user info file at %s", path)
 
-    def validate(self, username: str, password: str) -> bool:
-        return self.users.get(username) == password
+    def validate(self, username: bytes, password: bytes) -> bool:
+        # The username ends at the first colon, as in the file, so passwords
+        # may contain one but usernames may not
+        return b":" not in username and \
+            self.digest(b"%b:%b" % (username, password)) in self.credentials
 
 
 class GameRoom:
-    def __init__(self) -> None:
-        self.players = list[Player]()
-        self._lock = threading.Lock()
-        self.begin = threading.Event()
-        self.finish = threading.Event()
-        self.abort = threading.Event()
-        self.clean = threading.Event()
-        self.clean.set()
+    class State(Enum):
+        WAITING = auto()
+        RUNNING = auto()
+        ABORTED = auto()
+
+    def __init__(self, max_players: int) -> None:
+        self.MAX_PLAYERS = max_players
+        # Seat number -> player; a player's seat is kept in Player.slot
+        self.slots = dict[int, Player]()
+        self.state = GameRoom.State.WAITING
 
     def __len__(self) -> int:
-        return len(self.players)
+        return len(self.slots)
+
+    def is_full(self) -> bool:
+        # A room stays closed until every player of the last game has left
+        return (self.state != GameRoom.State.WAITING
+                or len(self.slots) >= self.MAX_PLAYERS)
+
+    def add_player(self, player: Player) -> int | None:
+        for slot in range(self.MAX_PLAYERS):
+            if self.slots.setdefault(slot, player) is player:
+                player.slot = slot
+                ROOMS_LIST_CACHE[0] = None
+                return slot
 
-    def add_player(self, player: Player) -> bool | None:
-        with self._lock:
-            if player not in self.players:
-                self.players.append(player)
-            else:
-                log.warning(f"{player} is already in the room")
+        log.warning("No free seat for %s in the room", player)
+        return None
 
     def remove_player(self, player: Player) -> None:
-        with self._lock:
-            if player in self.players:
-                self.players.remove(player)
-            else:
-                log.warning(
-                    f"Trying to remove {player} from room, but not found"
-                )
+        if player.slot is not None and self.slots.get(player.slot) is player:
+            del self.slots[player.slot]
+            ROOMS_LIST_CACHE[0] = None
+        else:
+            log.warning("Trying to remove %s from room, but not found", player)
+
+        if not self.slots:
+            self.reset()
 
     def start(self) -> None:
         raise NotImplementedError
 
     def reset(self) -> None:
-        self.players = list[Player]()
-        self.begin.clear()
-        self.finish.clear()
-        self.abort.clear()
-        self.clean.set()
-
-    def cleanup(self) -> None:
-        for p in self.players:
-            with p.lock:
-                p.state = Player.State.LOBBY
-                p.room = None
-
-        self.reset()
+        self.slots.clear()
+        self.state = GameRoom.State.WAITING
 
 
 class GuessGameRoom(GameRoom):
     def __init__(self) -> None:
-        super().__init__()
-        self.MAX_PLAYERS = 2
-
-    def add_player(self, player: Player) -> bool:
-        if len(self.players) == self.MAX_PLAYERS:
-            player.send("3013 The room is full")
-            return True
+        super().__init__(max_players=2)
+        # Indexed by seat; owned by the room and cleared in place per game
+        self.guesses: list[bool | None] = [None] * self.MAX_PLAYERS
+        # Players still to guess; the game resolves when it reaches zero
+        self.pending_guesses = 0
 
-        super().add_player(player)
+    def add_player(self, player: Player) -> int | None:
+        slot = super().add_player(player)
 
-        with self._lock:
-            self.clean.wait()
-            if len(self.players) != self.MAX_PLAYERS:
-                player.send("3011 Wait")
-                return False
+        if len(self.slots) != self.MAX_PLAYERS:
+            player.send(MSG.WAIT)
+        else:
+            self.start()
+        return slot
 
-        self.start(player)
-        return True
+    def start(self) -> None:
+        if log.getLogger().isEnabledFor(log.INFO):
+            log.info("Starting game in room with players: %s",
+                     ', '.join([str(player) for player in self.slots.values()]))
+        self.state = GameRoom.State.RUNNING
+        for slot in range(self.MAX_PLAYERS):
+            self.guesses[slot] = None
+        self.pending_guesses = len(self.slots)
+
+        # Brodcast game start
+        for player in self.slots.values():
+            player.state = Player.State.INGAME
+            player.send(MSG.STARTED)
 
-    def get_guess(self, player: Player) -> None:
-        log.info(f"Waiting for guess from {player}")
-        while True:
-            try:
-                with player.lock:
-                    msg = player.sock.recv(1024).decode("ascii").split()
-                    log.debug(f"Received message from {player}: {msg}")
-                    if len(msg) == 2 and msg[0] == "/guess" and msg[1] in ["true", "false"]:
-                        self.guesses[player] = msg[1] == "true"
-                        self.got_guess[player].set()
-                        return
-                log.warning(f"Received invalid message from {player}: {msg}")
-                player.send(
-                    "4002 Unrecognized message")
-            except UnicodeDecodeError as e:
-                log.error(f"Unicode decode error: {e}")
-                player.send(
-                    "4002 Unrecognized message")
-            except socket.error as e:
-                log.error(f"Socket error: {e}")
-                player.exit()
-                raise player.exitedException
-
-    def start(self, player: Player) -> None:
-        try:
-            assert len(self.players) == self.MAX_PLAYERS
-        except AssertionError:
-            log.error("Invalid number of players when starting game")
+    def handle_guess(self, player: Player, guess: bool) -> None:
+        if self.guesses[player.slot] is not None:
+            log.warning("%s has already guessed", player)
+            handle_unknown_msg(
+                player, b"/guess %s" % (b"true" if guess else b"false"))
             return
 
-        try:
-            self.clean.clear()
-            # Brodcast game start
-            self.begin.set()
-            log.info("Starting game in room with players: " +
-                     ''.join([str(player) for player in self.players]))
-            self.guesses: dict[Player, bool | None] = {
-                player: None for player in self.players}
-            self.got_guess = {player: threading.Event()
-                              for player in self.players}
-
-            log.info(f"Notifying \"starter\" {player}")
-            with player.lock:
-                player.state = Player.State.INGAME
-            player.send(
-                "3012 Game started. Please guess true or false")
-            self.get_guess(player)
-
-            # Wait for all players to finish
-            for p in self.players:
-                self.got_guess[p].wait()
-
-            # Game main logic
-            if self.abort.is_set():
-                return
-
-            with self._lock:
-                if self.guesses[self.players[0]] == self.guesses[self.players[1]]:
-                    # Tie
-                    for p in self.players:
-                        p.send("3023 The result is a tie")
-                else:
-                    ans = random.choice([True, False])
-                    winner_id = self.guesses[self.players[1]] == ans
+        log.info("Received guess from %s: %s", player, guess)
+        self.guesses[player.slot] = guess
 
-                    winner = self.players[winner_id]
-                    loser = self.players[not winner_id]
+        if self.state == GameRoom.State.ABORTED:
+            # The opponent is gone, so this player wins by default
+            player.leave()
+            player.send(MSG.WIN)
+            return
 
-                    winner.send("3021 You won this game")
-                    loser.send("3022 You lost this game")
+        # Wait for all players to finish
+        self.pending_guesses -= 1
+        if self.pending_guesses:
+            return
 
-            for p in self.players:
-                p.leave()
+        self.resolve()
 
-            self.finish.set()
+    def resolve(self) -> None:
+        # A running room is full, so seats 0..MAX_PLAYERS-1 are all taken
+        players = [self.slots[slot] for slot in range(self.MAX_PLAYERS)]
+        for p in players:
+            p.leave()
 
-            threading.Thread(target=self.cleanup).start()
+        if self.guesses[0] == self.guesses[1]:
+            # Tie
+            for p in players:
+                p.send(MSG.TIE)
+        else:
+            ans = bool(random.getrandbits(1))
+            winner_id = self.guesses[1] == ans
 
-        except Player.ExitedException as e:
-            self.handle_player_exit(e)
+            winner = players[winner_id]
+            loser = players[not winner_id]
 
-    def handle_player_exit(self, e: Player.ExitedException) -> None:
-        log.error(f"{e}")
-        self.remove_player(e.player)
-        self.abort.set()
+            winner.send(MSG.WIN)
+            loser.send(MSG.LOSE)
 
-        # Resolve other players
-        for player in self.players:
-            try:
-                if player.state == Player.State.LOBBY:
-                    continue
+    def handle_player_exit(self, player: Player) -> None:
+        log.error("%s exited unexpectedly", player)
+        self.remove_player(player)
+        if self.state == GameRoom.State.WAITING:
+            return
 
-                if player.state == Player.State.WAITING:
-                    player.send(
-                        "3012 Game started. Please guess true or false")
-                    with player.lock:
-                        player.state = Player.State.INGAME
-                    player.sock.recv(1024)
+        self.state = GameRoom.State.ABORTED
 
-                # INGAME
-                try:
-                    player.send("3021 You won this game")
-                except Player.ExitedException as ee:
-                    log.error(f"{ee}")
-                    self.remove_player(ee.player)
-            except socket.error as se:
-                log.error(f"Socket error: {se}")
-                self.remove_player(player)
+        # Resolve other players; those yet to guess win once their guess arrives
+        # Copied, as leave() frees seats while iterating
+        for p in list(self.slots.values()):
+            if self.guesses[p.slot] is not None:
+                p.leave()
+                p.send(MSG.WIN)
 
-        threading.Thread(target=self.cleanup).start()
+    def reset(self) -> None:
+        super().reset()
+        self.pending_guesses = 0
 
 
 ROOM_COUNT = 8
 rooms = [GuessGameRoom() for _ in range(ROOM_COUNT)]
+# Encoded /list reply; cleared whenever a room's population changes
+ROOMS_LIST_CACHE: list[bytes | None] = [None]
+
+MAX_MSG_LENGTH = 1024
+RECV_SIZE = 4096
+SOCKET_BUFFER_SIZE = 65536
+# Shared by every connection, since the event loop runs on a single thread
+recv_buf = bytearray(RECV_SIZE)
+recv_view = memoryview(recv_buf)
+epoll = select.epoll()
+players_by_fd = dict[int, Player]()
+unflushed = set[Player]()
+# accept() failures from running out of descriptors or memory
+ACCEPT_EXHAUSTED_ERRNOS = frozenset(
+    {errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM})
+
+
+def disconnect(player: Player) -> None:
+    # Already closed
+    if player.sock.fileno() == -1:
+        return
 
-
-def authenticate(sock: socket.socket, addr: socket._RetAddress, user_list: UserList) -> bool:
-    log.info(f"Authenticating {format_ip(addr)}")
+    # Best effort: deliver replies queued earlier in this loop pass
     try:
-        authenticated = False
-        while not authenticated:
-            msg = sock.recv(1024).decode("ascii").split()
-            if len(msg) == 3 and msg[0] == "/login":
-                username, password = msg[1], msg[2]
-                if user_list.validate(username, password):
-                    sock.send("1001 Authentication successful".encode("ascii"))
-                    authenticated = True
-                else:
-                    sock.send("1002 Authentication failed".encode("ascii"))
-            else:
-                log.warning(
-                    f"Received invalid message from"
-                    f"{format_ip(addr)}: {msg}"
-                )
-                sock.send("4002 Unrecognized message".encode("ascii"))
-    finally:
-        return authenticated
+        player.flush()
+    except Player.ExitedException:
+        pass
+
+    player.exit()
+    unflushed.discard(player)
+    epoll.unregister(player.sock.fileno())
+    del players_by_fd[player.sock.fileno()]
+    player.sock.close()
+
+    room = player.room
+    player.room = None
+    if room is not None:
+        room.handle_player_exit(player)
+
+
+def authenticate(player: Player, username: bytes, password: bytes,
+                 user_list: UserList) -> None:
+    log.info("Authenticating %s", player)
+    if user_list.validate(username, password):
+        player.state = Player.State.LOBBY
+        player.send(MSG.AUTH_OK)
+        log.info("%s successfully logged in", player)
+    else:
+        player.send(MSG.AUTH_FAIL)
 
 
 def handle_list(player: Player) -> None:
-    log.info(f"{player} requested room list")
-    player.send(
-        f"3001 {len(rooms)} {' '.join([str(len(room)) for room in rooms])}"
-    )
+    log.info("%s requested room list", player)
+    if ROOMS_LIST_CACHE[0] is None:
+        ROOMS_LIST_CACHE[0] = b"3001 %d %b\n" % (
+            len(rooms), b" ".join([b"%d" % len(room) for room in rooms]))
+    player.send(ROOMS_LIST_CACHE[0])
 
 
-def handle_enter(player: Player, room_id_str: str) -> None:
-    log.info(f"{player} requested to enter room {room_id_str}")
-    room_id = int(room_id_str) - 1
-    room = rooms[room_id]
-    if player.join(room):
+def handle_enter(player: Player, room_id: int) -> None:
+    if not 1 <= room_id <= len(rooms):
+        handle_unknown_msg(player, b"/enter %d" % room_id)
         return
 
-    try:
-        log.info(f"{player} is waiting for game to start")
-        # Wait for game to start
-        while not room.begin.is_set():
-            if room.abort.is_set():
-                player.leave()
-                return
+    log.info("%s requested to enter room %d", player, room_id)
+    room = rooms[room_id - 1]
+    if not player.join(room):
+        player.send(MSG.FULL)
 
-        # Game started
-        log.info(f"Notifying {player}")
-        with player.lock:
-            player.state = Player.State.INGAME
-        player.send(
-            "3012 Game started. Please guess true or false")
-        room.get_guess(player)
 
-        # Wait for game to finish
-        while not room.finish.is_set():
-            if room.abort.is_set():
+def handle_exit(player: Player) -> None:
+    player.send(MSG.BYE)
+    disconnect(player)
+
+
+def handle_guess(player: Player, guess: bool) -> None:
+    # The kernel drops TCP_QUICKACK after a recv; keep ACKing guesses at once
+    player.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+    room = player.room
+    if room is not None:
+        room.handle_guess(player, guess)
+    else:
+        handle_unknown_msg(player, b"/guess %s" % (b"true" if guess else b"false"))
+
+
+def handle_unknown_msg(player: Player, msg: bytes) -> None:
+    if player.state == Player.State.AUTHENTICATING:
+        log.warning("Received invalid login message from %s", player)
+    else:
+        log.warning("Received invalid message from %s: %r", player, msg)
+    player.send(MSG.BAD)
+
+
+# The whole client grammar, matched in one pass; the last group to match
+# names the command
+CMD_RE = re.compile(
+    rb"\s*/(?:"
+    rb"login (?P<username>\S+) (?P<password>\S+)"
+    rb"|(?P<list>list)"
+    rb"|enter (?P<room>\d{1,3})"
+    rb"|(?P<exit>exit)"
+    rb"|guess (?P<guess>true|false)"
+    rb")\s*"
+)
+
+
+def handle_message(player: Player, frame: bytes, user_list: UserList) -> None:
+    if player.state == Player.State.AUTHENTICATING:
+        # Login frames carry a password, so they are never logged
+        log.info("Received login message from %s", player)
+    else:
+        log.info("Received message from %s: %r", player, frame)
+    m = CMD_RE.fullmatch(frame)
+    match (player.state, m.lastgroup if m else None):
+        case (Player.State.AUTHENTICATING, "password"):
+            authenticate(player, m["username"], m["password"], user_list)
+        case (Player.State.LOBBY, "list"):
+            handle_list(player)
+        case (Player.State.LOBBY, "room"):
+            handle_enter(player, int(m["room"]))
+        case (Player.State.LOBBY, "exit"):
+            handle_exit(player)
+        case (Player.State.INGAME, "guess"):
+            handle_guess(player, m["guess"] == b"true")
+        case _:
+            handle_unknown_msg(player, frame)
+
+
+def handle_frames(player: Player, buf: bytearray, start: int, end: int,
+                  user_list: UserList) -> int:
+    # Handle every complete frame in buf[start:end] and return the offset
+    # consumed up to. Frames are copied straight out of buf, which is usually
+    # recv_buf itself.
+    with memoryview(buf) as view:
+        while player.state != Player.State.DISCONNECTED:
+            idx = buf.find(b"\n", start, end)
+            if idx == -1:
                 break
 
-        return
+            if idx - start > MAX_MSG_LENGTH:
+                log.warning("Discarding oversized message from %s", player)
+                start = idx + 1
+                player.send(MSG.BAD)
+                continue
 
-    except Player.ExitedException as e:
-        room.handle_player_exit(e)
+            frame = view[start:idx].tobytes()
+            start = idx + 1
+            try:
+                handle_message(player, frame, user_list)
+            except Exception:
+                # One bad frame must not take down every other connection
+                log.exception("Failed to handle message from %s", player)
+                handle_unknown_msg(player, frame)
+
+    return start
 
 
-def handle_unknown_msg(player: Player, msg: str) -> None:
+def receive(player: Player, n: int, user_list: UserList) -> None:
+    start = 0
+    if player.discarding:
+        # The oversized message was already answered; resume after its end
+        idx = recv_buf.find(b"\n", 0, n)
+        if idx == -1:
+            return
+        player.discarding = False
+        start = idx + 1
+
+    if player.rxbuf:
+        # Complete the pending partial frame first
+        player.rxbuf += recv_view[start:n]
+        consumed = handle_frames(
+            player, player.rxbuf, 0, len(player.rxbuf), user_list)
+        del player.rxbuf[:consumed]
+    else:
+        # Common case: parse in place and keep only an unterminated tail
+        consumed = handle_frames(player, recv_buf, start, n, user_list)
+        player.rxbuf += recv_view[consumed:n]
 
-    log.warning(f"Received invalid message from {player}: {msg}")
-    player.send("4002 Unrecognized message")
+    if len(player.rxbuf) > MAX_MSG_LENGTH:
+        log.warning("Discarding oversized message from %s", player)
+        player.rxbuf.clear()
+        player.discarding = True
+        if player.state != Player.State.DISCONNECTED:
+            player.send(MSG.BAD)
 
 
-MSG_HANDLERS = {"/list": handle_list, "/enter": handle_enter}
-MSG_LENGTHS = {"/list": 1, "/enter": 2}
+def flush_players() -> None:
+    while unflushed:
+        player = unflushed.pop()
+        try:
+            player.flush()
+        except Player.ExitedException as e:
+            log.error("%s", e)
+            disconnect(player)
 
 
-def handle_client(sock: socket.socket, addr: socket._RetAddress, user_list: UserList) -> None:
+def handle_writable(player: Player) -> None:
+    player.writable = True
     try:
-        if not authenticate(sock, addr, user_list):
-            log.error("Failed to authenticate user")
+        player.flush()
+    except Player.ExitedException as e:
+        log.error("%s", e)
+        disconnect(player)
+
+
+def handle_readable(player: Player, events: int, user_list: UserList) -> None:
+    # A hangup may arrive in the same event as the last data, so in that case
+    # read until EOF whatever size the reads return
+    hangup = events & (select.EPOLLRDHUP | select.EPOLLHUP | select.EPOLLERR)
+
+    readable = True
+    while readable and player.state != Player.State.DISCONNECTED:
+        try:
+            n = player.sock.recv_into(recv_view)
+        except BlockingIOError:
+            return
+        except socket.error as e:
+            log.error("Socket error: %s", e)
+            disconnect(player)
             return
-    except socket.error as e:
-        log.error(f"Socket error: {e}")
 
-    player = Player(sock, addr)
-    log.info(f"{player} successfully logged in")
-    handle_lobby(player)
+        # "The server can detect “EOF” by a receive of 0 bytes."
+        # https://docs.python.org/3/howto/sockets.html#creating-a-socket
+        if not n:  # Client EOF
+            log.error("Received empty message from %s, disconnected", player)
+            disconnect(player)
+            return
+
+        # A short read drained the receive queue, so skip the recv that would
+        # only raise EAGAIN; edge-triggered epoll signals the next arrival
+        if n < RECV_SIZE and not hangup:
+            readable = False
 
+        receive(player, n, user_list)
 
-def handle_lobby(player: Player) -> None:
-    sock = player.sock
 
-    # Receive messages
+def accept_clients(server_socket: socket.socket) -> None:
+    # Edge-triggered: accept until the backlog is empty
     while True:
         try:
-            msg = sock.recv(1024).decode("ascii")
-            segs = msg.split()
-
-            # "The server can detect “EOF” by a receive of 0 bytes."
-            # https://docs.python.org/3/howto/sockets.html#creating-a-socket
-            if not msg:  # Client EOF
-                log.error(
-                    f"Received empty message from {player}, disconnected"
-                )
-                sock.close()
-                break
+            conn, addr = server_socket.accept()
+        except BlockingIOError:
+            return
+        except socket.error as e:
+            log.error("Socket error when accepting client: %s", e)
+            # Retrying at once would fail the same way, so wait for the next
+            # edge; any other error only lost this one connection
+            if e.errno in ACCEPT_EXHAUSTED_ERRNOS:
+                return
+            continue
 
-            log.info(f"Received message from {player}: {msg}")
-            if segs[0] == "/exit" and len(segs) == 1:
-                player.send("4001 Bye Bye")
-                sock.close()
-                break
-            elif segs[0] in MSG_HANDLERS and len(segs) == MSG_LENGTHS[segs[0]]:
-                MSG_HANDLERS[segs[0]](player, *segs[1:])
-            else:
-                handle_unknown_msg(player, msg)
-        except UnicodeDecodeError as e:
-            log.error(f"Unicode decode error: {e}")
-            player.send("4002 Unrecognized message")
+        try:
+            conn.setblocking(False)
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
         except socket.error as e:
-            log.error(f"Socket error: {e}")
-            sock.close()
-            player.exit()
-            break
-        except Player.ExitedException as e:
-            log.error(f"{e}")
-            break
+            log.error("Socket error when setting up client: %s", e)
+            conn.close()
+            continue
+
+        log.info("Client %s established connection", format_ip(addr))
+        players_by_fd[conn.fileno()] = Player(conn, addr)
+        epoll.register(conn.fileno(), select.EPOLLIN | select.EPOLLOUT |
+                       select.EPOLLRDHUP | select.EPOLLET)
 
 
 def main() -> None:
@@ -417,10 +571,10 @@ def main() -> None:
         user_info_path = Path(sys.argv[2])
         assert user_info_path.exists()
     except TypeError as e:
-        log.critical(f"Invalid path: {e}")
+        log.critical("Invalid path: %s", e)
         exit(1)
     except ValueError as e:
-        log.critical(f"Invalid path: {e}")
+        log.critical("Invalid path: %s", e)
         exit(1)
     except AssertionError:
         log.critical("File does not exist")
@@ -434,27 +588,43 @@ def main() -> None:
         assert 0 <= port <= 65535
 
         server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # Accepted sockets inherit the buffer sizes; they must be set before
+        # listen() to take part in window scaling negotiation
+        server_socket.setsockopt(
+            socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+        server_socket.setsockopt(
+            socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
         server_socket.bind(("", port))
-        server_socket.listen(5)
+        server_socket.listen(socket.SOMAXCONN)
+        server_socket.setblocking(False)
+        epoll.register(server_socket.fileno(),
+                       select.EPOLLIN | select.EPOLLET)
     except AssertionError as e:
-        log.critical(f"Invalid port: {e}")
+        log.critical("Invalid port: %s", e)
         exit(1)
     except socket.error as e:
-        log.critical(f"Socket error: {e}")
+        log.critical("Socket error: %s", e)
         exit(1)
-    log.info(f"Server started on port {port}")
+    log.info("Server started on port %d", port)
 
-    # Accept connections
+    # Event loop: one thread serves every connection
     while True:
-        try:
-            conn, addr = server_socket.accept()
-        except socket.error as e:
-            log.error(f"Socket error when accepting client: {e}")
-            continue
-
-        log.info(f"Client {format_ip(addr)} established connection")
-        threading.Thread(target=handle_client, args=(
-            conn, addr, user_list)).start()
+        for fd, events in epoll.poll():
+            if fd == server_socket.fileno():
+                accept_clients(server_socket)
+                continue
+
+            player = players_by_fd.get(fd)
+            if player is None:
+                continue
+            if events & select.EPOLLOUT:
+                handle_writable(player)
+            if events & ~select.EPOLLOUT:
+                handle_readable(player, events, user_list)
+
+        flush_players()
 
 
 if __name__ == "__main__":